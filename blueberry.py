@@ -1,9 +1,12 @@
-from gpiozero import Button, LED, OutputDevice
+from gpiozero import Button, LED, OutputDevice, Device
+from gpiozero.pins.lgpio import LGPIOFactory
 from enum import IntEnum
 from bluetoothaudio import BluetoothAudio, NoConnectedDeviceError
+from dbus_fast import DBusError
 import subprocess
 from datetime import datetime
-from time import sleep
+import asyncio
+import traceback
 
 class Pins(IntEnum):
 
@@ -13,90 +16,159 @@ class Pins(IntEnum):
     INDICATOR_LED = 11
     POWER_3V3_PIN = 0
 
+BUTTON_BOUNCE_TIME = 0.02 # Time in seconds to ignore further edges after a button press (debounce)
+
+# Use lgpio for interrupt driven button edges instead of the default pin factory
+Device.pin_factory = LGPIOFactory()
+
 # Initialize the buttons and LED
-prev_button = Button(Pins.LEFT_BUTTON_READ, pull_up = True)
-pauseplay_button = Button(Pins.MIDDLE_BUTTON_READ, pull_up = True)
-next_button = Button(Pins.RIGHT_BUTTON_READ, pull_up = True)
+prev_button = Button(Pins.LEFT_BUTTON_READ, pull_up = True, bounce_time = BUTTON_BOUNCE_TIME)
+pauseplay_button = Button(Pins.MIDDLE_BUTTON_READ, pull_up = True, bounce_time = BUTTON_BOUNCE_TIME)
+next_button = Button(Pins.RIGHT_BUTTON_READ, pull_up = True, bounce_time = BUTTON_BOUNCE_TIME)
 indicator_led = LED(Pins.INDICATOR_LED)
 power_pin = OutputDevice(Pins.POWER_3V3_PIN, active_high = True)
 
 AUTOCONNECT_PAUSE = 5 # Delay in seconds between attempts of autoconnecting to a device
-VERIFY_CONNECTION_PAUSE = 3 # Delay in seconds between verification that a device is connected
 BUTTON_HOLD_TIME = 3 # Time in seconds to hold a button to activate its secondary use
 WRITE_ERROR_LOG = False # Whether or not to write an error log when there is an exception
 
 # Initialize Bluetooth Audio Object
 bluetooth_audio = BluetoothAudio()
 
-def shutdown():
+# Set by the bluez signal handler when the connected device disconnects, created in main()
+connection_lost: asyncio.Event = None
+
+# Running button tasks, asyncio only keeps weak references to tasks so they must be referenced here until done
+button_tasks = set()
+
+def write_error_log(e, message = None):
+    """ Appends the date, time and description of an exception to the error log if WRITE_ERROR_LOG is enabled.
+        An optional message (e.g. what is done about the error) is written after the description.
+    """
+    if WRITE_ERROR_LOG:
+        with open('errorlog.txt', 'a') as error_log:
+            now = datetime.now()
+            date_str = now.strftime("%m/%d/%Y")
+            time_str = now.strftime("%H:%M:%S")
+
+            error_log.write(f'Error on {date_str} @ {time_str}')
+            error_log.write(f'Description: {str(e)}')
+            if message is not None:
+                error_log.write(message)
+
+async def shutdown():
     """ LED Blinks 5 times rapidly, music is paused, then Pi is shutdown.
     """
-    indicator_led.blink(on_time=0.5, off_time=0.5, n=5, background=False)
-    bluetooth_audio.pause()
+    # Blink in the background and wait asynchronously, so the event loop keeps running during the blinks
+    indicator_led.blink(on_time=0.5, off_time=0.5, n=5, background=True)
+    await asyncio.sleep(5 * (0.5 + 0.5))
+    await bluetooth_audio.pause()
     subprocess.call(['sudo', 'shutdown', 'now'])
 
-def restart():
+async def restart():
     """ LED Blinks 10 times extremely rapidly, music is paused, then Pi is shutdown and restart.
     """
-    indicator_led.blink(on_time=0.25, off_time=0.25, n=10, background=False)
-    bluetooth_audio.pause()
+    # Blink in the background and wait asynchronously, so the event loop keeps running during the blinks
+    indicator_led.blink(on_time=0.25, off_time=0.25, n=10, background=True)
+    await asyncio.sleep(10 * (0.25 + 0.25))
+    await bluetooth_audio.pause()
     subprocess.call(['sudo', 'shutdown', '-r', 'now'])
 
 def run_if_connected(func):
-    """ Takes a function and creates a new function that only runs when a bluetooth device is connected.
+    """ Takes a coroutine function and creates a new coroutine function that only runs when a bluetooth device is connected.
         The new function attempts to run and catches no connected device errors.
     """
-    def new_func():
+    async def new_func():
         if bluetooth_audio.connected_device:
             try:
-                func()
-            except NoConnectedDeviceError:
+                await func()
+            except (NoConnectedDeviceError, DBusError):
                 # Even after the connected_device check, a no connected device error may occur
                 # This happens when the connected_device was unexpectedly disconnected
-                # In this case, verify_connection will update the connected_device to NullDevice
-                bluetooth_audio.verify_connection()
-                pass
+                # A dbus error occurs when the media player went away before bluez signalled it
+                # In both cases, verify_connection will update the connected_device and drop the cached media player
+                await bluetooth_audio.verify_connection()
+
+    return new_func
+
+def on_button_task_done(task):
+    """ Releases a finished button task and reports the exception it raised, if any.
+    """
+    button_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        e = task.exception()
+        traceback.print_exception(type(e), e, e.__traceback__)
+        write_error_log(e)
+
+def start_button_task(func):
+    """ Runs a coroutine function as a task that is kept referenced until it is done.
+    """
+    task = asyncio.create_task(func())
+    button_tasks.add(task)
+    task.add_done_callback(on_button_task_done)
+
+def run_in_loop(loop, func):
+    """ Takes a coroutine function and creates a regular function that schedules it as a task on the given event loop.
+        gpiozero runs button callbacks in its own threads, so the task is handed to the loop thread safely.
+    """
+    def new_func():
+        loop.call_soon_threadsafe(start_button_task, func)
 
     return new_func
 
-def init_buttons():
+def init_buttons(loop):
     """ Initialize button functionality
     """
     power_pin.on()
 
     # Previous track, pause/play, and next track functionality on button presses
-    prev_button.when_pressed = run_if_connected(bluetooth_audio.previous_song)
-    pauseplay_button.when_pressed = run_if_connected(bluetooth_audio.play_pause_toggle)
-    next_button.when_pressed = run_if_connected(bluetooth_audio.next_song)
+    prev_button.when_pressed = run_in_loop(loop, run_if_connected(bluetooth_audio.previous_song))
+    pauseplay_button.when_pressed = run_in_loop(loop, run_if_connected(bluetooth_audio.play_pause_toggle))
+    next_button.when_pressed = run_in_loop(loop, run_if_connected(bluetooth_audio.next_song))
 
     # Hold left button to shut off raspberry pi
     prev_button.hold_time = BUTTON_HOLD_TIME
-    prev_button.when_held = shutdown
+    prev_button.when_held = run_in_loop(loop, shutdown)
 
     # Hold middle button to pair to a new device
     pauseplay_button.hold_time = BUTTON_HOLD_TIME
-    pauseplay_button.when_held = bluetooth_audio.autopair
+    pauseplay_button.when_held = run_in_loop(loop, bluetooth_audio.autopair)
 
     # Hold right button to automatically connect to a different paired device
     next_button.hold_time = BUTTON_HOLD_TIME
-    next_button.when_held = bluetooth_audio.connect_different_device
+    next_button.when_held = run_in_loop(loop, bluetooth_audio.connect_different_device)
 
 
-if __name__ == '__main__':
+def on_connection_changed(device):
+    """ Called by bluetooth_audio when bluez signals that a device connected or disconnected.
+        LED stays solid on while a device is connected and blinks slowly when connection is lost.
+    """
+    if device:
+        indicator_led.on()
+    else:
+        indicator_led.blink(on_time=1, off_time=1, background=True)
+        connection_lost.set()
+
+async def main():
+    global connection_lost
 
     try:
-        init_buttons()
+        connection_lost = asyncio.Event()
+        await bluetooth_audio.connect_dbus()
+        bluetooth_audio.on_connection_changed = on_connection_changed
+        init_buttons(asyncio.get_running_loop())
         while True:
             # Attempt autoconnect till a device is connected
             # LED blinks slowly when attempting to connect
-            indicator_led.blink(on_time=1, off_time=1, background=True)
-            while not bluetooth_audio.autoconnect():
-                sleep(AUTOCONNECT_PAUSE)
+            if not bluetooth_audio.connected_device:
+                indicator_led.blink(on_time=1, off_time=1, background=True)
+            while not await bluetooth_audio.autoconnect():
+                await asyncio.sleep(AUTOCONNECT_PAUSE)
             # LED stays solid on when connection is established
             indicator_led.on()
-            # Verify connection till connection is lost
-            while bluetooth_audio.verify_connection():
-                sleep(VERIFY_CONNECTION_PAUSE)
+            # Nothing needs to be polled while connected, bluez signals when the connection is lost
+            connection_lost.clear()
+            await connection_lost.wait()
 
     except Exception as e:
 
@@ -104,20 +176,10 @@ if __name__ == '__main__':
         # This program is meant to start on bootup so the raspberry pi automatically acts as a bluetooth speaker
         # To make this program start automatically on bootup, add it to your /etc/rc.local
 
-        if WRITE_ERROR_LOG:
-            with open('errorlog.txt', 'a') as error_log:
-                now = datetime.now()
-                date_str = now.strftime("%m/%d/%Y")
-                time_str = now.strftime("%H:%M:%S")
-
-                error_log.write(f'Error on {date_str} @ {time_str}')
-                error_log.write(f'Description: {str(e)}')
-                error_log.write(f'Restarting')
+        write_error_log(e, 'Restarting')
         
-        restart()
-
-
+        await restart()
 
 
-            
-
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,20 +1,30 @@
 from bluetoothctl import BluetoothCtl, BluetoothDevice
-import dbus
+from dbus_fast import DBusError, InterfaceNotFoundError, Message, MessageType, Variant, unpack_variants
+from dbus_fast.aio import MessageBus, ProxyInterface
+import asyncio
 import subprocess
-from typing import Union, Tuple
+from typing import Any, Callable, Dict, List, Optional, Union, Tuple
 
 class NoConnectedDeviceError(RuntimeError):
     pass
 
 class BluetoothAudio():
     """ Singleton class that implements bluetooth audio functions for the Raspberry Pi
-        Requires bluetoothctl and bluealsa-aplay cli tools to be installed
-        Also requires dbus and dbus python library
-        These should all already be installed by default on Raspbian
+        Requires the bluealsa-aplay cli tool to be installed
+        Also requires dbus and the dbus-fast python library
+        The cli tool and dbus should already be installed by default on Raspbian
+        connect_dbus() must be awaited before any other functions are used
     """
 
     instance: 'BluetoothAudio' = None
 
+    # Public BluetoothCtl attributes that are delegated to by __getattr__
+    _DELEGATED = frozenset(name for name in dir(BluetoothCtl) if not name.startswith('_'))
+
+    # Match rule for PropertiesChanged signals of every bluez object (devices, media players, etc.)
+    BLUEZ_PROPERTIES_CHANGED_MATCH_RULE = ("type='signal',sender='org.bluez',"
+                                           "interface='org.freedesktop.DBus.Properties',member='PropertiesChanged'")
+
     @classmethod
     def get_instance(cls):
         if cls.instance is None:
@@ -25,11 +35,42 @@ class BluetoothAudio():
         if self.instance is not None:
             raise RuntimeError('Only one instance of class BluetoothAudio should exist at a time. Use BluetoothAudio.get_instance() instead.')
         self.bluetoothctl: BluetoothCtl = BluetoothCtl()
-        self.connected_device: BluetoothDevice = self.bluetoothctl.get_connected_device()
-        self.bus = dbus.SystemBus()
-        self.dbus_manager = dbus.Interface(self.bus.get_object("org.bluez","/"), "org.freedesktop.DBus.ObjectManager")
+        self.connected_device: BluetoothDevice = BluetoothDevice.NullDevice()
+        # Every device that is connected (connected_device is one of them), kept up to date by bluez signals
+        self._connected_devices: List[BluetoothDevice] = []
+        # Called with the new connected_device whenever it changes (see _set_connected_device)
+        self.on_connection_changed: Optional[Callable[[BluetoothDevice], None]] = None
+        # Serializes autoconnect, connect_different_device and autopair, created in connect_dbus within the event loop
+        self._connection_lock: asyncio.Lock = None
+        self.bus: MessageBus = None
+        self.dbus_manager: ProxyInterface = None
+        # The media player of the connected device is cached and kept up to date by bluez signals
+        self._player_path: Optional[str] = None
+        self._player_iface: Optional[ProxyInterface] = None
+        self._player_props: Dict[str, Any] = {}
         self.audio_forwarding_subprocess = self._forward_audio_to_rpi_output()
 
+    async def connect_dbus(self):
+        """ Connects to the system bus, gets the bluez "org.freedesktop.DBus.ObjectManager" dbus interface and the connected device.
+            Must be awaited from within the running asyncio event loop before any other functions are used.
+            The system bus connection is shared with the BluetoothCtl object.
+        """
+        self._connection_lock = asyncio.Lock()
+        self.bus = await self.bluetoothctl.connect_bus()
+        introspection = await self.bus.introspect("org.bluez", "/")
+        self.dbus_manager = self.bus.get_proxy_object("org.bluez", "/", introspection).get_interface(
+            "org.freedesktop.DBus.ObjectManager")
+        self.dbus_manager.on_interfaces_added(self._on_interfaces_added)
+        self.dbus_manager.on_interfaces_removed(self._on_interfaces_removed)
+        reply = await self.bus.call(Message(destination="org.freedesktop.DBus", path="/org/freedesktop/DBus",
+                                            interface="org.freedesktop.DBus", member="AddMatch", signature="s",
+                                            body=[self.BLUEZ_PROPERTIES_CHANGED_MATCH_RULE]))
+        # bus.call returns error replies instead of raising, and without the match rule no connection changes are seen
+        if reply.message_type == MessageType.ERROR:
+            raise DBusError(reply.error_name, reply.body[0] if reply.body else "AddMatch failed", reply)
+        self.bus.add_message_handler(self._on_properties_changed)
+        await self._sync_connected_devices()
+
     def _forward_audio_to_rpi_output(self) -> subprocess.Popen:
         """ Forwards the incoming bluetooth audio stream to the headphone jack of the Raspberry Pi
             Runs in a bluealsa-aplay 00:00:00:00:00:00 in a subprocess 
@@ -38,137 +79,239 @@ class BluetoothAudio():
         audio_forwarding_subprocess = subprocess.Popen(['bluealsa-aplay', '00:00:00:00:00:00'])
         return audio_forwarding_subprocess
 
-    def connect(self, device: Union[str, BluetoothDevice]) -> bool: 
+    async def connect(self, device: Union[str, BluetoothDevice]) -> bool: 
         """ Connects to a device using its mac address.
             Returns True if the operation success and the device is connected, False otherwise. 
         """
-        success = self.bluetoothctl.connect(device)
+        success = await self.bluetoothctl.connect(device)
         if success:
-            if type(self.connected_device) is BluetoothDevice:
-                self.connected_device = device
-            elif type(self.connected_device) is str:
-                self.connected_device = BluetoothDevice(device)
+            if type(device) is str:
+                device = BluetoothDevice(device)
+            self._add_connected_device(device)
+            self._set_connected_device(device)
         return success
 
-    def disconnect(self) -> bool:
+    async def disconnect(self) -> bool:
         """ Disconnects from the currently connected device and returns success of operation.
         """
-        success = self.bluetoothctl.disconnect()
+        success = await self.bluetoothctl.disconnect()
         if success:
-            self.connected_device = BluetoothDevice.NullDevice()
+            # bluetoothctl disconnects every connected device
+            self._connected_devices = []
+            self._set_connected_device(BluetoothDevice.NullDevice())
         return success
 
-    def autoconnect(self) -> bool:
+    async def autoconnect(self) -> bool:
         """ Automatically connects to a paired device.
             Returns True if the operation success and a device is connected, False otherwise. 
         """
-        paired_devices = self.bluetoothctl.get_paired_devices()
-        if self.connected_device:
-            return True
-        for device in paired_devices:
-            success = self.connect(device)
-            if success:
+        async with self._connection_lock:
+            # Resynchronize first, a device may be connected that the signals did not report as connected_device
+            await self._sync_connected_devices()
+            if self.connected_device:
                 return True
-        return False
+            paired_devices = await self.bluetoothctl.get_paired_devices()
+            for device in paired_devices:
+                success = await self.connect(device)
+                if success:
+                    return True
+            return False
 
-    def connect_different_device(self) -> bool:
+    async def connect_different_device(self) -> bool:
         """ Connects to a different device than the device which is already connected.
+            Holds the connection lock, so autoconnect started by the disconnect waits until the new device is connected.
         """
-        paired_devices = self.bluetoothctl.get_paired_devices()
-        for device in paired_devices:
-            if device != self.connected_device:
-                success = self.disconnect() and self.connect(device)
-                if success:
-                    return True
-        return False
+        async with self._connection_lock:
+            paired_devices = await self.bluetoothctl.get_paired_devices()
+            for device in paired_devices:
+                if device != self.connected_device:
+                    success = await self.disconnect() and await self.connect(device)
+                    if success:
+                        return True
+            return False
 
-    def autopair(self) -> bool:
+    async def autopair(self) -> bool:
         """ Automatically pairs and connects to a device that is not already paired.
             Returns True if the operation success and a device is connected, False otherwise. 
         """
-        self.bluetooth_ctl.make_discoverable()
-        discoverable_devices = self.bluetoothctl.get_discoverable_devices()
-        for device in discoverable_devices:
-            success = self.bluetoothctl.pair(device) and self.connect(device)
-            if success:
-                return True
-        return False
+        async with self._connection_lock:
+            await self.bluetoothctl.make_discoverable()
+            discoverable_devices = await self.bluetoothctl.get_discoverable_devices()
+            for device in discoverable_devices:
+                success = await self.bluetoothctl.pair(device) and await self.connect(device)
+                if success:
+                    return True
+            return False
 
-    def verify_connection(self) -> bool:
+    async def verify_connection(self) -> bool:
         """ Verifies that a device is still connected and has not been disconnected.
             It does not ensure the same device as earlier is connected, only that a device is connected.
             If the connected_device has changed, this updates it.
-            This should be called every so often to ensure that connection has not been lost.
+            connected_device is also kept up to date by bluez signals, so this is only needed to resynchronize it.
+            The cached media player is dropped too, so it is looked up again on next use.
             Returns the connection status (True if a device is still connected, False if no device is connected)
         """
-        actual_connected_device = self.bluetoothctl.get_connected_device()
+        self._clear_media_player()
         connection_status = bool(self.connected_device)
-        if actual_connected_device != self.connected_device:
-            self.connected_device = actual_connected_device
+        await self._sync_connected_devices()
         return connection_status
 
-    def _get_media_control_interface(self) -> Tuple[dbus.Interface, dbus.Dictionary]:
-        """ Uses dbus to lookup the connected device and find the "org.bluez.MediaPlayer1" dbus interface.
-            Returns a tuple with the "org.bluez.MediaPlayer1" dbus interface and the media state dbus dictionary.
-        """
-        objects = self.dbus_manager.GetManagedObjects()
-        media = None
-        media_control_interface = None
-
-        for path in objects.keys():
-            interfaces = objects[path]
-            for interface in interfaces.keys():
-                if interface == "org.bluez.Device1":
-                    props = interfaces[interface]
-                    if props["Connected"] == 1:
-                        for player in range(0, 2): # Player can be 0 or 1
-                            fullpath = path + '/player' + str(player)
-                            if fullpath in objects:
-                                media = objects[fullpath]["org.bluez.MediaPlayer1"]
-                                break
-                        media_control_interface = dbus.Interface(
-                            self.bus.get_object("org.bluez", fullpath), "org.bluez.MediaPlayer1")
-
-        if media is None or media_control_interface is None:
+    async def _sync_connected_devices(self):
+        """ Reads the connected devices from bluez. connected_device is kept if it is still connected.
+        """
+        self._connected_devices = await self.bluetoothctl.get_connected_devices()
+        if self.connected_device not in self._connected_devices:
+            self._set_connected_device(self._get_next_connected_device())
+
+    def _add_connected_device(self, device: BluetoothDevice):
+        if device not in self._connected_devices:
+            self._connected_devices.append(device)
+
+    def _get_next_connected_device(self) -> BluetoothDevice:
+        """ Returns one of the connected devices, or NullDevice if no device is connected.
+        """
+        if self._connected_devices:
+            return self._connected_devices[0]
+        return BluetoothDevice.NullDevice()
+
+    def _set_connected_device(self, device: BluetoothDevice):
+        """ The single place connected_device is changed. Calls on_connection_changed if connected_device changed.
+        """
+        if device == self.connected_device:
+            return
+        self.connected_device = device
+        if self.on_connection_changed is not None:
+            self.on_connection_changed(self.connected_device)
+
+    def _clear_media_player(self):
+        """ Invalidates the cached media player so that it is looked up again on next use.
+        """
+        self._player_path = None
+        self._player_iface = None
+        self._player_props = {}
+
+    def _is_cached_player_under(self, path: str) -> bool:
+        """ Returns True if the cached media player is the object at path or one of its children.
+        """
+        return self._player_path is not None and (self._player_path == path or self._player_path.startswith(path + '/'))
+
+    def _on_interfaces_added(self, path: str, interfaces: Dict[str, Dict[str, Variant]]):
+        """ Handler for the bluez "InterfacesAdded" signal. A new media player invalidates the cached one.
+        """
+        if "org.bluez.MediaPlayer1" in interfaces:
+            self._clear_media_player()
+
+    def _on_interfaces_removed(self, path: str, interfaces: List[str]):
+        """ Handler for the bluez "InterfacesRemoved" signal. Removal of the cached media player or its device invalidates it.
+            Removal of the connected device is treated as a disconnect.
+        """
+        if self._is_cached_player_under(path):
+            self._clear_media_player()
+        if "org.bluez.Device1" in interfaces:
+            self._on_device_connection_changed(path, False)
+
+    def _on_properties_changed(self, message: Message):
+        """ Handler for bluez "PropertiesChanged" signals.
+            Keeps the cached media state up to date and invalidates the media player when its device connects or disconnects.
+        """
+        if (message.message_type != MessageType.SIGNAL or message.member != "PropertiesChanged"
+                or message.interface != "org.freedesktop.DBus.Properties"):
+            return
+        interface, changed, _ = message.body
+        if interface == "org.bluez.MediaPlayer1" and message.path == self._player_path:
+            self._player_props.update(unpack_variants(changed))
+        elif interface == "org.bluez.Device1" and "Connected" in changed:
+            if self._is_cached_player_under(message.path):
+                self._clear_media_player()
+            self._on_device_connection_changed(message.path, changed["Connected"].value)
+
+    def _on_device_connection_changed(self, path: str, connected: bool):
+        """ Updates connected_device when the device at the dbus path connects or disconnects.
+        """
+        device = BluetoothDevice.from_dbus_path(path)
+        if connected:
+            self._add_connected_device(device)
+            self._set_connected_device(device)
+            return
+        if device in self._connected_devices:
+            self._connected_devices.remove(device)
+        if device == self.connected_device:
+            # Another device may still be connected, in which case it becomes the connected_device
+            self._set_connected_device(self._get_next_connected_device())
+
+    async def _find_media_player(self):
+        """ Uses dbus to find the "org.bluez.MediaPlayer1" dbus interface of the connected device.
+            The media player is a child of the connected device's dbus path, so no search of bluez objects is needed.
+            Caches the path, interface and properties of the media player if one is found.
+        """
+        if not self.connected_device:
+            return
+
+        for player in range(0, 2): # Player can be 0 or 1
+            fullpath = self.connected_device.dbus_path + '/player' + str(player)
+            try:
+                introspection = await self.bus.introspect("org.bluez", fullpath)
+                proxy_object = self.bus.get_proxy_object("org.bluez", fullpath, introspection)
+                player_iface = proxy_object.get_interface("org.bluez.MediaPlayer1")
+                properties = proxy_object.get_interface("org.freedesktop.DBus.Properties")
+                player_props = await properties.call_get_all("org.bluez.MediaPlayer1")
+            except (DBusError, InterfaceNotFoundError):
+                continue
+            self._player_iface = player_iface
+            self._player_props = unpack_variants(player_props)
+            self._player_path = fullpath
+            return
+
+    async def _get_media_control_interface(self) -> Tuple[ProxyInterface, Dict[str, Any]]:
+        """ Gets the "org.bluez.MediaPlayer1" dbus interface of the connected device.
+            The media player is only looked up over dbus when there is no cached media player.
+            Returns a tuple with the "org.bluez.MediaPlayer1" dbus interface and the media state dictionary.
+        """
+        if self._player_path is None:
+            await self._find_media_player()
+
+        if self._player_path is None:
             raise NoConnectedDeviceError("Cannot get bluez MediaPlayer interface when no device is connected.")
 
-        return media_control_interface, media
+        return self._player_iface, self._player_props
 
-    def is_paused(self) -> bool:
-        _, media = self._get_media_control_interface()
+    async def is_paused(self) -> bool:
+        _, media = await self._get_media_control_interface()
         return media["Status"]
 
-    def play(self):
-        media_control_interface, _ = self._get_media_control_interface()
-        media_control_interface.Play()
+    async def play(self):
+        media_control_interface, _ = await self._get_media_control_interface()
+        await media_control_interface.call_play()
 
-    def pause(self):
-        media_control_interface, _ = self._get_media_control_interface()
-        media_control_interface.Pause()
+    async def pause(self):
+        media_control_interface, _ = await self._get_media_control_interface()
+        await media_control_interface.call_pause()
 
-    def play_pause_toggle(self):
-        media_control_interface, media = self._get_media_control_interface()
+    async def play_pause_toggle(self):
+        media_control_interface, media = await self._get_media_control_interface()
         if media["Status"] == "paused":
-            media_control_interface.Play()
+            await media_control_interface.call_play()
         else:
-            media_control_interface.Pause()
+            await media_control_interface.call_pause()
 
-    def next_song(self):
-        media_control_interface, _ = self._get_media_control_interface()
-        media_control_interface.Next()
+    async def next_song(self):
+        media_control_interface, _ = await self._get_media_control_interface()
+        await media_control_interface.call_next()
 
-    def previous_song(self):
-        media_control_interface, _ = self._get_media_control_interface()
-        media_control_interface.Previous()
+    async def previous_song(self):
+        media_control_interface, _ = await self._get_media_control_interface()
+        await media_control_interface.call_previous()
 
     def __del__(self):
-        self.disconnect()
+        # The system bus connection is closed when the BluetoothCtl object is deleted
         del self.bluetoothctl
         self.audio_forwarding_subprocess.kill()
 
     def __getattr__(self, attr):
         # For any functions that don't exist in this module but exist in bluetoothctl, automatically use those functions
         # This removes the need to create a wrapper for every function in BluetoothCtl class
-        if hasattr(self.bluetoothctl, attr):
-            return self.bluetoothctl.__getattribute__(attr)
+        # Only public BluetoothCtl attributes are delegated, any other missing attribute fails immediately
+        if attr not in self._DELEGATED:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{attr}'")
+        return getattr(self.bluetoothctl, attr)
 
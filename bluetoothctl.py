@@ -1,154 +1,185 @@
-import pexpect
-import re
-from typing import List, Union
+from dbus_fast import BusType, DBusError, InterfaceNotFoundError, unpack_variants
+from dbus_fast.aio import MessageBus, ProxyInterface
+from dbus_fast.service import ServiceInterface, method
+import asyncio
+from typing import Any, Dict, List, Tuple, Union
 from bluetoothdevice import BluetoothDevice
 
 class BluetoothCtlError(RuntimeError):
-    """An error with the bluetoothctl cli tool."""
+    """An error communicating with bluez over dbus."""
     pass
 
 
-class BluetoothCtl:
-    """A wrapper for bluetoothctl command line tool using pexpect."""
+class PairingAgent(ServiceInterface):
+    """A bluez pairing agent with no input or output capability, which accepts every pairing and service request.
+
+    bluez needs a registered agent to pair with devices, which the bluetoothctl command line tool used to provide.
+    """
 
-    BLUETOOTHCTL_EXPECT_RE = re.compile(rb"#") # Regex indicating end of bluetoothctl command (only a hash mark is needed)
-    ANSI_COLOR_CODE_RE = re.compile('\033\\[([0-9]+)(;[0-9]+)*m') # Regex for ANSI color codes
+    PATH = "/blueberry/agent" # dbus path the agent is exported at
+    CAPABILITY = "NoInputNoOutput"
 
     def __init__(self):
-        self.child = pexpect.spawn("sudo bluetoothctl", echo=False, timeout=60)
+        super().__init__("org.bluez.Agent1")
 
-    def _run_command(self, command: str) -> List[str]:
-        """Run a command in bluetoothctl prompt and return the output as a list of lines.
+    @method()
+    def Release(self) -> None:
+        pass
 
-        Args:
-            command: the command to run
+    @method()
+    def RequestPinCode(self, device: 'o') -> 's':
+        return "0000"
 
-         Returns:
-            out: A list of the lines in the output of the command after an expectation has been met
-        """
-        self.child.sendline(command)
-        matched_index = self.child.expect([pexpect.EOF, self.BLUETOOTHCTL_EXPECT_RE])
-        if matched_index == 0:
-            raise BluetoothCtlError("bluetoothctl failed while running " + command)
-        out = self._get_command_output()
-        return out
+    @method()
+    def DisplayPinCode(self, device: 'o', pincode: 's') -> None:
+        pass
 
-    def _run_command_get_success(self, command: str, success_expect: List[str] = [], fail_expect: List[str] = []) -> bool:
-        """Run a command in bluetoothctl prompt and return the output as a list of lines.
+    @method()
+    def RequestPasskey(self, device: 'o') -> 'u':
+        return 0
 
-        Args:
-            command: the command to run
-            success_expect: a list of strings for pexpect.spawn().expect() to expect when command is ran succesfully
-            fail_expect: a list of strings for pexpect.spawn().expect() to expect when command is ran unsucessfully
+    @method()
+    def DisplayPasskey(self, device: 'o', passkey: 'u', entered: 'q') -> None:
+        pass
 
-         Returns:
-            success: True if the command was run succesfully, False otherwise
-        """
-        self.child.sendline(command)
-        matched_index = self.child.expect([pexpect.EOF] + success_expect + fail_expect)
-        if matched_index == 0:
-            raise BluetoothCtlError("bluetoothctl failed while running " + command)
-        success = matched_index <= len(success_expect)
-        return success
+    @method()
+    def RequestConfirmation(self, device: 'o', passkey: 'u') -> None:
+        pass
+
+    @method()
+    def RequestAuthorization(self, device: 'o') -> None:
+        pass
+
+    @method()
+    def AuthorizeService(self, device: 'o', uuid: 's') -> None:
+        pass
+
+    @method()
+    def Cancel(self) -> None:
+        pass
+
+
+class BluetoothCtl:
+    """A wrapper for the bluez dbus api that provides the functionality of the bluetoothctl command line tool.
+
+    connect_bus() must be awaited before any other function is used.
+    """
+
+    BLUEZ_SERVICE = "org.bluez"
+    ADAPTER_PATH = BluetoothDevice.DBUS_ADAPTER_PATH
+    ADAPTER_INTERFACE = "org.bluez.Adapter1"
+    DEVICE_INTERFACE = "org.bluez.Device1"
+
+    def __init__(self):
+        self.bus: MessageBus = None
+        self._interfaces: Dict[Tuple[str, str], ProxyInterface] = {}
+
+    async def connect_bus(self) -> MessageBus:
+        """Connect to the system bus if not already connected and return the connection.
 
-    def _run_command_for_duration(self, command: str, runtime: float) -> List[str]:
-        """Run a command in bluetoothctl prompt for certain amount of time or until the finished_expect is found.
+        On first connection, a PairingAgent is exported and registered as the default bluez agent.
+        """
+        if self.bus is None:
+            self.bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+            await self._register_agent()
+        return self.bus
+
+    async def _register_agent(self):
+        """Export a PairingAgent on the bus and register it with bluez as the default agent."""
+        self.bus.export(PairingAgent.PATH, PairingAgent())
+        agent_manager = await self._get_interface("/org/bluez", "org.bluez.AgentManager1")
+        try:
+            await agent_manager.call_register_agent(PairingAgent.PATH, PairingAgent.CAPABILITY)
+            await agent_manager.call_request_default_agent(PairingAgent.PATH)
+        except DBusError as e:
+            raise BluetoothCtlError(f"Failed to register pairing agent: {e.text}") from e
+
+    async def _get_interface(self, path: str, interface: str) -> ProxyInterface:
+        """Get a proxy for a bluez dbus interface.
 
         Args:
-            command: the command to run
-            runtime: the max time in seconds to run the command for
+            path: the dbus path of the bluez object
+            interface: the name of the dbus interface
 
          Returns:
-            out: A list of the lines in the output of the command
-        """
-        self.child.sendline(command, timeout=runtime)
-        matched_index = self.child.expect([pexpect.EOF, pexpect.TIMEOUT, self.BLUETOOTHCTL_EXPECT_RE])
-        if matched_index == 0:
-            raise BluetoothCtlError("bluetoothctl failed while running " + command)
-        out = self._get_command_output()
-        return out
-
-    def _get_command_output(self) -> List[str]:
-        """ Returns the output of the last command run as a list of lines (strings).
-            Automatically called and returned by _run_command and run_command_for_duration functions.
-        """
-        out = self.child.before.split(b"\r\n")
-        decoded_out = []
-        for line in out:
-            line = line.decode("utf-8")
-            line = re.sub(self.ANSI_COLOR_CODE_RE, '', line) # remove ANSI color codes
-            decoded_out.append(line)
-        return decoded_out
-
-    def _parse_device_string(self, device_string: str) -> BluetoothDevice:
-        """Parse a string corresponding to a device and returns a device object."""
-        match = BluetoothDevice.MAC_ADDRESS_RE.search(device_string)
-        if match:
-            mac_address = device_string[match.start():match.end()]
-            device_name = device_string[match.end():]
-            return BluetoothDevice(mac_address, device_name)
-        else:
-            return BluetoothDevice.NullDevice()
+            proxy: the proxy interface, which is cached so that each object is only introspected once
 
-    def get_connected_device(self) -> BluetoothDevice:
+         Raises:
+            BluetoothCtlError: if bluez does not export the interface at the path (e.g. an unknown device)
+        """
+        if self.bus is None:
+            raise BluetoothCtlError("Not connected to the system bus, connect_bus() must be awaited first")
+        key = (path, interface)
+        if key not in self._interfaces:
+            try:
+                introspection = await self.bus.introspect(self.BLUEZ_SERVICE, path)
+                proxy_object = self.bus.get_proxy_object(self.BLUEZ_SERVICE, path, introspection)
+                self._interfaces[key] = proxy_object.get_interface(interface)
+            except (DBusError, InterfaceNotFoundError) as e:
+                raise BluetoothCtlError(f"Failed to get {interface} of {path}: {e}") from e
+        return self._interfaces[key]
+
+    def _get_device_path(self, mac_address: str) -> str:
+        """Returns the dbus path of the device with the given mac address."""
+        return BluetoothDevice(mac_address).dbus_path
+
+    async def _get_device_properties(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the properties of every device known to bluez, keyed by the dbus path of the device."""
+        manager = await self._get_interface("/", "org.freedesktop.DBus.ObjectManager")
+        objects = await manager.call_get_managed_objects()
+        return {path: unpack_variants(interfaces[self.DEVICE_INTERFACE])
+                for path, interfaces in objects.items() if self.DEVICE_INTERFACE in interfaces}
+
+    @staticmethod
+    def _device_from_properties(properties: Dict[str, Any]) -> BluetoothDevice:
+        """Create a device object from the "org.bluez.Device1" properties of a device."""
+        return BluetoothDevice(properties["Address"], properties.get("Name"))
+
+    async def get_connected_devices(self) -> List[BluetoothDevice]:
+        """Returns a list of connected devices."""
+        return [self._device_from_properties(properties)
+                for properties in (await self._get_device_properties()).values() if properties.get("Connected")]
+
+    async def get_connected_device(self) -> BluetoothDevice:
         """ Gets the currently connected device as a device object. Returns NullDevice if no device is connected."""
-        out = self._run_command('info')
-        device_name = None
-        mac_address = None
-        for line in out:
-            if mac_address is None:
-                match = BluetoothDevice.MAC_ADDRESS_RE.search(line)
-                if match:
-                    mac_address = line[match.start():match.end()]
-            if device_name is None:
-                name_index = line.find('Name: ')
-                if name_index != -1 and device_name is None:
-                    device_name = line[name_index + 6:]
-        if mac_address is None:
-            return BluetoothDevice.NullDevice()
-        else:
-            return BluetoothDevice(mac_address, device_name)
+        connected_devices = await self.get_connected_devices()
+        if connected_devices:
+            return connected_devices[0]
+        return BluetoothDevice.NullDevice()
 
-    def scan_for_bluetooth_devices(self, scantime) -> List[BluetoothDevice]:
+    async def scan_for_bluetooth_devices(self, scantime: float) -> List[BluetoothDevice]:
         """Scan for bluetooth devices and return list of devices found"""
-        out = self._run_command_for_duration("scan on", scantime)
-        devices = []
-        for line in out:
-            mac_addresses = BluetoothDevice.MAC_ADDRESS_RE.findall(line)
-            if len(mac_addresses) > 0:
-                devices.append(BluetoothDevice(mac_addresses[0]))
-        return devices
-
-    def make_discoverable(self):
+        adapter = await self._get_interface(self.ADAPTER_PATH, self.ADAPTER_INTERFACE)
+        await adapter.call_start_discovery()
+        try:
+            await asyncio.sleep(scantime)
+            # bluez only reports signal strength (RSSI) for devices seen during discovery
+            # It is cleared once discovery stops, so the devices must be read before stopping
+            device_properties = await self._get_device_properties()
+        finally:
+            await adapter.call_stop_discovery()
+        return [self._device_from_properties(properties)
+                for properties in device_properties.values() if "RSSI" in properties]
+
+    async def make_discoverable(self):
         """Make device discoverable."""
-        self._run_command("discoverable on")
+        adapter = await self._get_interface(self.ADAPTER_PATH, self.ADAPTER_INTERFACE)
+        await adapter.set_discoverable(True)
 
-    def get_available_devices(self) -> List[BluetoothDevice]:
+    async def get_available_devices(self) -> List[BluetoothDevice]:
         """Returns a list of paired and discoverable devices."""
-        out = self._run_command("devices")
-        available_devices = []
-        for line in out:
-            device = self._parse_device_string(line)
-            if device:
-                available_devices.append(device)
-        return available_devices
-
-    def get_paired_devices(self) -> List[BluetoothDevice]:
+        return [self._device_from_properties(properties)
+                for properties in (await self._get_device_properties()).values()]
+
+    async def get_paired_devices(self) -> List[BluetoothDevice]:
         """Returns a list of paired devices."""
-        out = self._run_command("paired-devices")
-        paired_devices = []
-        for line in out:
-            device = self._parse_device_string(line)
-            if device:
-                paired_devices.append(device)
-        return paired_devices
-
-    def get_discoverable_devices(self) -> List[BluetoothDevice]:
-        """Filter paired devices out of available."""
-        available = self.get_available_devices()
-        paired = self.get_paired_devices()
+        return [self._device_from_properties(properties)
+                for properties in (await self._get_device_properties()).values() if properties.get("Paired")]
 
-        return [d for d in available if d not in paired]
+    async def get_discoverable_devices(self) -> List[BluetoothDevice]:
+        """Filter paired devices out of available."""
+        return [self._device_from_properties(properties)
+                for properties in (await self._get_device_properties()).values() if not properties.get("Paired")]
 
     def _validate_mac_address(self, device: Union[BluetoothDevice, str]) -> str:
         mac_address = None
@@ -161,43 +192,61 @@ class BluetoothCtl:
         else:
             raise ValueError(f"{mac_address} is not a valid mac address")
 
-    def get_device_info(self, device: Union[BluetoothDevice, str]) -> str:
-        """Get device info by mac address."""
+    async def get_device_info(self, device: Union[BluetoothDevice, str]) -> Dict[str, Any]:
+        """Get device info (the "org.bluez.Device1" properties of the device) by mac address."""
         mac_address = self._validate_mac_address(device)
-        out = self._run_command("info " + mac_address)
-        return out
+        properties = await self._get_interface(self._get_device_path(mac_address), "org.freedesktop.DBus.Properties")
+        try:
+            return unpack_variants(await properties.call_get_all(self.DEVICE_INTERFACE))
+        except DBusError as e:
+            raise BluetoothCtlError(f"Failed to get info of {mac_address}: {e.text}") from e
 
-    def pair(self, device: Union[BluetoothDevice, str]) -> bool:
-        """Try to pair with a device by mac address, return success of the operation.."""
-        mac_address = self._validate_mac_address(device)
-        success_expect = ['Pairing sucessful']
-        fail_expect = ["Failed to pair", pexpect.TIMEOUT]
-        success = self._run_command_get_success("pair " + mac_address, success_expect, fail_expect)
-        return success
+    async def pair(self, device: Union[BluetoothDevice, str]) -> bool:
+        """Try to pair with a device by mac address, return success of the operation..
 
-    def remove(self, device: Union[BluetoothDevice, str]) -> bool:
+        The device is also trusted, so that bluez accepts its services when it reconnects on its own later.
+        """
+        mac_address = self._validate_mac_address(device)
+        try:
+            device_interface = await self._get_interface(self._get_device_path(mac_address), self.DEVICE_INTERFACE)
+            await device_interface.call_pair()
+            await device_interface.set_trusted(True)
+        except (DBusError, BluetoothCtlError):
+            return False
+        return True
+
+    async def remove(self, device: Union[BluetoothDevice, str]) -> bool:
         """Remove paired device by mac address, return success of the operation."""
         mac_address = self._validate_mac_address(device)
-        success_expect = ['Device has been removed']
-        fail_expect = ["not available", pexpect.TIMEOUT]
-        success = self._run_command_get_success("remove " + mac_address, success_expect, fail_expect)
-        return success
-
-    def connect(self, device: Union[BluetoothDevice, str]) -> bool:
+        try:
+            adapter = await self._get_interface(self.ADAPTER_PATH, self.ADAPTER_INTERFACE)
+            await adapter.call_remove_device(self._get_device_path(mac_address))
+        except (DBusError, BluetoothCtlError):
+            return False
+        return True
+
+    async def connect(self, device: Union[BluetoothDevice, str]) -> bool:
         """Try to connect to a device by mac address, return success of operation."""
         mac_address = self._validate_mac_address(device)
-        success_expect = ["Connection successful"]
-        fail_expect = ["Failed to connect", pexpect.TIMEOUT]
-        success = self._run_command_get_success("connect " + mac_address, success_expect, fail_expect)
-        return success
-
-    def disconnect(self) -> bool:
+        try:
+            device_interface = await self._get_interface(self._get_device_path(mac_address), self.DEVICE_INTERFACE)
+            await device_interface.call_connect()
+        except (DBusError, BluetoothCtlError):
+            return False
+        return True
+
+    async def disconnect(self) -> bool:
         """Disconnect from the currently connected device, return success of operation."""
-        success_expect = ["Successful disconnected", "Missing device address argument"]
-        # If bluetoothctl says we are missing device address argument that means there is no device connected
-        fail_expect = ["Failed to disconnect", pexpect.TIMEOUT]
-        success = self._run_command_get_success("disconnect", success_expect, fail_expect)
-        return success
+        # If there is no device connected, there is nothing to disconnect from and the operation succeeds
+        for path, properties in (await self._get_device_properties()).items():
+            if properties.get("Connected"):
+                try:
+                    device_interface = await self._get_interface(path, self.DEVICE_INTERFACE)
+                    await device_interface.call_disconnect()
+                except (DBusError, BluetoothCtlError):
+                    return False
+        return True
 
     def __del__(self):
-        self.child.close()
+        if self.bus is not None:
+            self.bus.disconnect()
@@ -4,7 +4,11 @@ import re
 class BluetoothDevice:
     """A class represeting a bluetooth device with a mac address and name."""
 
-    MAC_ADDRESS_RE = re.compile(r"(?:[0-9a-fA-F]:?){12}") # Regex for a mac address
+    MAC_ADDRESS_RE = re.compile(r"(?:[0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}") # Regex for a mac address (XX:XX:XX:XX:XX:XX)
+    MAC_ADDRESS_LENGTH = 17
+    NULL_MAC_ADDRESS = 'null' # Placeholder mac address of the null device
+    _NULL: 'BluetoothDevice' = None # Shared null device instance, created below the class
+    DBUS_ADAPTER_PATH = "/org/bluez/hci0" # bluez dbus path of the bluetooth adapter
 
     def __init__(self, mac_address: str, name: Optional[str] = None):
         self.mac_address = mac_address
@@ -12,11 +16,13 @@ class BluetoothDevice:
 
     @classmethod
     def NullDevice(cls) -> 'BluetoothDevice':
-        return cls('null')
+        return cls._NULL
 
     @staticmethod
     def is_valid_mac_address(mac_address) -> bool:
-        return mac_address is not None and BluetoothDevice.MAC_ADDRESS_RE.fullmatch(mac_address) is not None
+        # A mac address always has a fixed length, so anything else can be rejected without running the regex
+        return (mac_address is not None and len(mac_address) == BluetoothDevice.MAC_ADDRESS_LENGTH
+                and BluetoothDevice.MAC_ADDRESS_RE.fullmatch(mac_address) is not None)
 
     @property
     def mac_address(self):
@@ -24,18 +30,33 @@ class BluetoothDevice:
     
     @mac_address.setter
     def mac_address(self, mac_address: str):
-        if not self.is_valid_mac_address(mac_address) and mac_address != 'null':
+        if mac_address == self.NULL_MAC_ADDRESS:
+            self._mac_address = mac_address
+            return
+        if not self.is_valid_mac_address(mac_address):
             raise ValueError(f'{mac_address} is not a valid mac address')
-        self._mac_address = mac_address
+        # Stored in upper case like bluez reports them, so devices compare equal regardless of input case
+        self._mac_address = mac_address.upper()
+
+    @property
+    def dbus_path(self) -> str:
+        """The bluez dbus path of the device, which is derived from its mac address."""
+        return f"{self.DBUS_ADAPTER_PATH}/dev_{self._mac_address.replace(':', '_')}"
+
+    @classmethod
+    def from_dbus_path(cls, path: str) -> 'BluetoothDevice':
+        """Create a device object from the bluez dbus path of a device (or of one of its children)."""
+        device_node = path[path.rindex('/dev_') + len('/dev_'):].split('/')[0]
+        return cls(device_node.replace('_', ':'))
 
     def __bool__(self) -> bool:
         """ Magic method for boolean value of device.
         True if the device object is not a 'null' device
         """
-        return not self.__eq__(self.NullDevice())
+        return self._mac_address != self.NULL_MAC_ADDRESS
 
     def __repr__(self) -> bool:
-        if self.__eq__(self.NullDevice()):
+        if not self:
             return 'Null Device'
         name = self.name
         if name is None:
@@ -44,4 +65,12 @@ class BluetoothDevice:
     
     def __eq__(self, other: 'BluetoothDevice') -> bool:
         return self.mac_address == other.mac_address
-        
\ No newline at end of file
+
+    def __hash__(self) -> int:
+        return hash(self._mac_address)
+
+
+# The null device is created once without validation, so NullDevice() and bool() never construct a device or run the regex
+BluetoothDevice._NULL = object.__new__(BluetoothDevice)
+BluetoothDevice._NULL._mac_address = BluetoothDevice.NULL_MAC_ADDRESS
+BluetoothDevice._NULL.name = None